@@ -1,5 +1,8 @@
 import os
-import json
+import orjson
+import json5
+import partial_json_parser
+from partial_json_parser import Allow
 from flask import Flask, request, jsonify, Response
 from flask_cors import CORS
 from langchain.agents import AgentExecutor, create_react_agent
@@ -11,14 +14,50 @@ from langchain_core.callbacks import BaseCallbackHandler
 import time
 from queue import Queue, Empty
 import threading
+from concurrent.futures import ThreadPoolExecutor
 import random
+import uuid
 import re
-from langchain.memory import ConversationBufferMemory
+from collections import defaultdict, OrderedDict
+from langchain.memory import ConversationBufferWindowMemory
+from langchain_core.globals import set_llm_cache
+from langchain_community.cache import SQLiteCache
+
+# Prefix the ReAct agent puts before the answer it returns to the user
+FINAL_ANSWER_MARKER = "Final Answer:"
+
+# Markdown code fences LLMs tend to wrap JSON output in
+MARKDOWN_FENCE_RE = re.compile(r"```json\n?|\n?```")
+# Missing comma between properties on different lines, which JSON5 doesn't accept
+MISSING_COMMA_RE = re.compile(r'"\s*\n\s*"')
+
+def parse_llm_json(text):
+    # Strict parse first; fall back to JSON5, which tolerates the usual LLM
+    # mistakes (single quotes, trailing commas, unquoted keys), and finally
+    # to JSON5 after inserting missing commas between properties.
+    cleaned = MARKDOWN_FENCE_RE.sub("", text).strip()
+    try:
+        return orjson.loads(cleaned)
+    except orjson.JSONDecodeError:
+        pass
+    try:
+        return json5.loads(cleaned)
+    except ValueError:
+        return json5.loads(MISSING_COMMA_RE.sub('",\n"', cleaned))
 
 # Custom Callback Handler to capture agent steps and yield them for streaming
 class AgentStepCallbackHandler(BaseCallbackHandler):
     def __init__(self, queue):
         self.queue = queue
+        # Text generated so far by each in-flight LLM run
+        self.llm_buffers = {}
+        # Runs that reached their "Final Answer:" segment: the answer text so far
+        # and the top-level answer fields already sent to the client
+        self.answer_buffers = {}
+        self.sent_answer_fields = {}
+
+    def on_llm_start(self, serialized, prompts, *, run_id, **kwargs):
+        self.llm_buffers[run_id] = ""
 
     def on_agent_action(self, action, **kwargs):
         self.queue.put({"type": "action", "tool": action.tool, "tool_input": action.tool_input, "log": action.log})
@@ -35,54 +74,118 @@ class AgentStepCallbackHandler(BaseCallbackHandler):
         output_str = finish.return_values["output"]
         
         try:
-            # The output from the agent should be a JSON string.
-            # First, let's try to clean it up from common LLM mistakes.
-            
-            # 1. Remove markdown fences
-            cleaned_str = re.sub(r"```json\n?|\n?```", "", output_str)
-            
-            # 2. Replace single quotes with double quotes
-            cleaned_str = cleaned_str.replace("'", '"')
-            
-            # 3. Fix missing comma between properties on different lines
-            cleaned_str = re.sub(r'"\s*\n\s*"', '",\n"', cleaned_str)
-            
-            # 4. Try to parse it
-            json.loads(cleaned_str)
-            
-            # If it parses, we send it
-            self.queue.put({"type": "final_answer", "content": cleaned_str})
+            # The output from the agent should be a JSON object, possibly with
+            # common LLM formatting mistakes that the lenient parser accepts.
+            answer = parse_llm_json(output_str)
+            if not isinstance(answer, dict):
+                raise ValueError("Final answer is not a JSON object")
+            self.queue.put({"type": "final_answer", "content": orjson.dumps(answer).decode()})
 
         except Exception as e:
-            # If parsing fails after all our attempts, it means the LLM
-            # produced a severely malformed output.
+            # If parsing fails, it means the LLM produced a severely malformed output.
             print(f"--- ERROR: Could not parse LLM output as JSON ---\n{output_str}\n---")
             error_message = "I'm sorry, I seem to have gotten my thoughts tangled up and couldn't format my response correctly. Could you please try rephrasing your request?"
             # We still need to send a valid JSON object in the 'final_answer'
-            error_json = json.dumps({"conversation": error_message})
+            error_json = orjson.dumps({"conversation": error_message}).decode()
             self.queue.put({"type": "final_answer", "content": error_json})
 
-    def on_llm_new_token(self, token: str, **kwargs) -> None:
-        # This can be used for streaming LLM output token by token if needed
-        # For now, we'll focus on agent steps and final answer
-        pass
+    def on_llm_new_token(self, token: str, *, run_id, **kwargs) -> None:
+        # Stream only the "Final Answer:" part of the agent's output so the
+        # intermediate thoughts and tool calls are not shown to the user
+        if run_id in self.answer_buffers:
+            self.queue.put({"type": "token", "content": token})
+            self.answer_buffers[run_id] += token
+            self._send_answer_fields(run_id)
+            return
+
+        buffer = self.llm_buffers.get(run_id, "") + token
+        self.llm_buffers[run_id] = buffer
+        marker_index = buffer.find(FINAL_ANSWER_MARKER)
+        if marker_index != -1:
+            answer_start = buffer[marker_index + len(FINAL_ANSWER_MARKER):].lstrip()
+            self.answer_buffers[run_id] = answer_start
+            self.sent_answer_fields[run_id] = set()
+            if answer_start:
+                self.queue.put({"type": "token", "content": answer_start})
+                self._send_answer_fields(run_id)
+
+    def _send_answer_fields(self, run_id):
+        # Parse the incomplete answer JSON and send each top-level field as soon as
+        # it is complete, i.e. once the next field has started
+        try:
+            partial_answer = partial_json_parser.loads(
+                MARKDOWN_FENCE_RE.sub("", self.answer_buffers[run_id]), Allow.ALL, parser=orjson.loads
+            )
+        except Exception:
+            return
+        if not isinstance(partial_answer, dict):
+            return
+        sent_fields = self.sent_answer_fields[run_id]
+        for key in list(partial_answer)[:-1]:
+            if key not in sent_fields:
+                sent_fields.add(key)
+                self.queue.put({"type": "answer_field", "key": key, "value": partial_answer[key]})
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        self.llm_buffers.pop(run_id, None)
+        self.answer_buffers.pop(run_id, None)
+        self.sent_answer_fields.pop(run_id, None)
 
 
 # Load environment variables
 load_dotenv()
 
 # --- Data Loading ---
-def load_data():
-    base_dir = os.path.dirname(os.path.abspath(__file__))
-    with open(os.path.join(base_dir, "data/products.json"), "r") as f:
-        products = json.load(f)
-    with open(os.path.join(base_dir, "data/projects.json"), "r") as f:
-        projects = json.load(f)
-    with open(os.path.join(base_dir, "data/trends.json"), "r") as f:
-        trends = json.load(f)
-    return products, projects, trends
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
 
-PRODUCTS, PROJECTS, TRENDS = load_data()
+def load_data():
+    with open(os.path.join(DATA_DIR, "products.json"), "rb") as f:
+        products = orjson.loads(f.read())
+    with open(os.path.join(DATA_DIR, "projects.json"), "rb") as f:
+        projects = orjson.loads(f.read())
+    with open(os.path.join(DATA_DIR, "trends.json"), "rb") as f:
+        trends = orjson.loads(f.read())
+
+    # Group products by (category, velocity) so bundle building is a dict lookup
+    # instead of a scan over the whole catalog.
+    products_by_cat_vel = defaultdict(list)
+    for p in products:
+        products_by_cat_vel[(p.get('category'), p.get('velocity'))].append(p)
+
+    projects_by_trend = defaultdict(list)
+    for p in projects:
+        projects_by_trend[p["trend"].strip().lower()].append(p['name'])
+
+    # Flat (keyword, trend name) pairs, normalized once here and kept in trends.json
+    # order so get_trend returns the earliest-listed matching trend
+    keyword_list = []
+    for trend in trends:
+        for keyword in trend["keywords"]:
+            keyword = keyword.strip().lower()
+            if keyword:
+                keyword_list.append((keyword, trend["name"]))
+
+    return {
+        "products": products,
+        "projects": projects,
+        "trends": trends,
+        "products_by_cat_vel": dict(products_by_cat_vel),
+        "projects_by_name": {p['name']: p for p in projects},
+        "projects_by_trend": dict(projects_by_trend),
+        "keyword_list": keyword_list,
+    }
+
+DATA = load_data()
+PRODUCTS = DATA["products"]
+PROJECTS = DATA["projects"]
+TRENDS = DATA["trends"]
+PRODUCTS_BY_CAT_VEL = DATA["products_by_cat_vel"]
+PROJECTS_BY_NAME = DATA["projects_by_name"]
+PROJECTS_BY_TREND = DATA["projects_by_trend"]
+# (keyword, trend name) pairs in trends.json order
+KW_LIST = DATA["keyword_list"]
+# Maps normalized project names to their canonical spelling
+PROJECT_NAMES = {name.strip().lower(): name for name in PROJECTS_BY_NAME}
 
 # --- Agent Tools ---
 
@@ -93,11 +196,10 @@ def get_trend(query: str) -> str:
     This simulates the Trend Spotter Agent.
     """
     query_lower = query.lower()
-    for trend in TRENDS:
-        for keyword in trend["keywords"]:
-            if keyword in query_lower:
-                print(f"Found trend: {trend['name']}")
-                return trend["name"]
+    for keyword, trend_name in KW_LIST:
+        if keyword in query_lower:
+            print(f"Found trend: {trend_name}")
+            return trend_name
     return "No specific trend identified."
 
 @tool
@@ -107,22 +209,17 @@ def get_projects_for_trend(trend_name: str) -> list[str]:
     This simulates the Project Planner Agent.
     """
     normalized_trend_name = trend_name.strip().lower()
-    matching_projects = [p['name'] for p in PROJECTS if p["trend"].strip().lower() == normalized_trend_name]
+    matching_projects = PROJECTS_BY_TREND.get(normalized_trend_name, [])
     if matching_projects:
         print(f"Found {len(matching_projects)} projects for {trend_name}: {matching_projects}")
         return matching_projects
     return []
 
-@tool
-def create_bundle_for_project(project_name: str) -> dict:
+def build_bundle(project_name: str) -> dict:
     """
-    Creates a product bundle for a given project, intelligently selecting products
-    based on category, ensuring at least one low-velocity item is included,
-    and prioritizing high/medium velocity for the remaining items.
-    It also uses an LLM to refine the project steps and generate catchy descriptions for low-velocity items.
-    This simulates the Assortment Optimizer Agent.
+    Builds the project bundle returned by `create_bundle_for_project`.
     """
-    project = next((p for p in PROJECTS if p['name'] == project_name.strip()), None)
+    project = PROJECTS_BY_NAME.get(project_name.strip())
     if not project:
         return {"error": f"Project '{project_name}' not found."}
 
@@ -139,7 +236,7 @@ def create_bundle_for_project(project_name: str) -> dict:
     low_velocity_placed = False
     for i, ingredient in enumerate(ingredients):
         required_category = ingredient['category']
-        low_velocity_options = [p for p in PRODUCTS if p.get('category') == required_category and p.get('velocity') == 'low']
+        low_velocity_options = PRODUCTS_BY_CAT_VEL.get((required_category, 'low'))
         if low_velocity_options:
             chosen_item = random.choice(low_velocity_options)
             bundle.append(chosen_item)
@@ -155,7 +252,7 @@ def create_bundle_for_project(project_name: str) -> dict:
         selected_item = None
         # Prioritize High -> Medium -> Low, avoiding already used SKUs if possible
         for velocity_level in ['high', 'medium', 'low']:
-            options = [p for p in PRODUCTS if p.get('category') == required_category and p.get('velocity') == velocity_level and p.get('sku') not in used_skus]
+            options = [p for p in PRODUCTS_BY_CAT_VEL.get((required_category, velocity_level), ()) if p.get('sku') not in used_skus]
             if options:
                 selected_item = random.choice(options)
                 break
@@ -163,7 +260,7 @@ def create_bundle_for_project(project_name: str) -> dict:
         # If no unused item was found, fall back to any item from that category
         if not selected_item:
             for velocity_level in ['high', 'medium', 'low']:
-                options = [p for p in PRODUCTS if p.get('category') == required_category and p.get('velocity') == velocity_level]
+                options = PRODUCTS_BY_CAT_VEL.get((required_category, velocity_level))
                 if options:
                     selected_item = random.choice(options)
                     break
@@ -175,82 +272,150 @@ def create_bundle_for_project(project_name: str) -> dict:
             return {"error": f"Could not find a suitable product for category '{required_category}'"}
 
     # --- New LLM-based refinement ---
+    # Catchy descriptions for low-velocity items and refined project steps are
+    # requested together in one JSON prompt, so the tool makes a single LLM call.
+    # The shared product and project data is never modified; the annotations go
+    # on copies so concurrent requests don't see each other's results.
+    bundle = [dict(item) for item in bundle]
+    refined_steps = []
+    low_velocity_items = [item for item in bundle if item.get('velocity') == 'low']
+    original_steps = project.get('steps', [])
 
-    # 1. Generate catchy descriptions for low-velocity items
-    for item in bundle:
-        if item.get('velocity') == 'low':
-            prompt = f"The project is '{project['name']}'. The product is '{item['name']}'. Write a short, catchy phrase (max 15 words) to highlight why this product is a great addition to the project, making it more appealing to a customer. For example, for a red ribbon, you could say 'adds a pop of vibrant color to your creation!'"
-            response = llm.invoke(prompt)
-            item['catchy_description'] = response.content.strip().replace('"', '')
+    if low_velocity_items or original_steps:
+        items_list = ", ".join([f"'{item['name']}'" for item in bundle])
+        low_velocity_list = "\n".join([f"- {item['sku']}: '{item['name']}'" for item in low_velocity_items]) or "(none)"
+        original_steps_str = "\n".join(original_steps) or "(none)"
+        prompt = f"""You are a helpful assistant for a craft store. Project: '{project['name']}'. Bundle Items: {items_list}.
 
+1. For each promoted product below, write a short, catchy phrase (max 15 words) to highlight why this product is a great addition to the project, making it more appealing to a customer. For example, for a red ribbon, you could say 'adds a pop of vibrant color to your creation!'
+Promoted products (SKU: name):
+{low_velocity_list}
 
-    # 2. Refine project steps
-    original_steps = project.get('steps', [])
-    if original_steps:
-        items_list = ", ".join([f"'{item['name']}'" for item in bundle])
-        original_steps_str = "\n".join(original_steps)
-        prompt = f"You are a helpful assistant for a craft store. Your task is to refine a generic list of project steps to make them more specific and engaging based on the actual products selected for the project bundle. Project: '{project['name']}'. Bundle Items: {items_list}.\n\nGiven these items, refine the following steps. Rewrite them to be more inspiring and mention the specific products where appropriate. Keep the same number of steps. Do not include any introductory text like 'Refined Steps:'. Just provide the numbered list of steps.\n\nOriginal Steps:\n{original_steps_str}\n\nRefined Steps:"
+2. Refine the generic project steps below to make them more specific and engaging based on the bundle items. Rewrite them to be more inspiring and mention the specific products where appropriate. Keep the same number of steps and do not number them.
+Original Steps:
+{original_steps_str}
+
+Respond with only a JSON object of the form {{"catchy": {{"<SKU>": "<phrase>"}}, "refined_steps": ["<step>", ...]}}."""
         response = llm.invoke(prompt)
-        response_content = response.content.strip()
-        # Split into lines and clean each line
-        refined_steps = []
-        for step in response_content.split('\n'):
-            step = step.strip()
+        try:
+            refinement = parse_llm_json(response.content)
+        except ValueError:
+            # Keep the bundle usable with the original steps if the LLM output is malformed
+            print(f"--- ERROR: Could not parse bundle refinement as JSON ---\n{response.content}\n---")
+            refinement = {}
+        if not isinstance(refinement, dict):
+            refinement = {}
+
+        catchy = refinement.get('catchy')
+        if not isinstance(catchy, dict):
+            catchy = {}
+        for item in low_velocity_items:
+            if catchy.get(item['sku']):
+                item['catchy_description'] = str(catchy[item['sku']]).strip().replace('"', '')
+
+        steps = refinement.get('refined_steps')
+        if not isinstance(steps, list):
+            steps = []
+        for step in steps:
+            step = str(step).strip()
             if step:
                 # Remove markdown bolding and leading numbers/dots
                 step = step.replace('**', '')
                 if '.' in step and step.split('.')[0].isdigit():
                     step = '.'.join(step.split('.')[1:]).strip()
                 refined_steps.append(step)
-        project['steps'] = refined_steps
 
 
     print(f"Created bundle for {project_name}: {bundle}")
     project_with_bundle = project.copy()
+    if original_steps and refined_steps:
+        project_with_bundle['steps'] = refined_steps
     project_with_bundle['bundle'] = bundle
     project_with_bundle['project_name'] = project['name']
     return project_with_bundle
 
+def format_bundle_answer(project_name: str, result: dict) -> str:
+    # Wrap a bundle in the final-answer JSON the frontend expects
+    if "error" in result:
+        answer = {"conversation": result["error"]}
+    else:
+        answer = {"conversation": f"Here's everything you need for {project_name.strip()}!", "project": result}
+    return orjson.dumps(answer).decode()
+
+# The bundle is returned straight to the user (return_direct), so the agent doesn't
+# spend another LLM round-trip just to copy it into a Final Answer.
+@tool(return_direct=True)
+def create_bundle_for_project(project_name: str) -> str:
+    """
+    Creates a product bundle for a given project, intelligently selecting products
+    based on category, ensuring at least one low-velocity item is included,
+    and prioritizing high/medium velocity for the remaining items.
+    It also uses an LLM to refine the project steps and generate catchy descriptions for low-velocity items.
+    This simulates the Assortment Optimizer Agent.
+    """
+    return format_bundle_answer(project_name, build_bundle(project_name))
+
 
 
 # --- LangChain Orchestration ---
-llm = ChatGoogleGenerativeAI(model="${{ values.llmModel }}", temperature=0)
+# Cache LLM responses on disk. With temperature=0 the prompts are deterministic,
+# so picking the same project again skips the Gemini round-trips entirely.
+set_llm_cache(SQLiteCache(database_path=os.path.join(os.path.dirname(os.path.abspath(__file__)), ".langchain_cache.db")))
+
+# Streaming lets the callback handler forward tokens of the final answer as they arrive.
+# The gRPC transport keeps one persistent HTTP/2 channel that every call (agent turns and
+# the bundle refinement inside the tools) reuses, avoiding a new connection per request.
+# This client is shared module-wide and must not be re-created per tool call.
+llm = ChatGoogleGenerativeAI(model="${{ values.llmModel }}", temperature=0, streaming=True, transport="grpc")
 
 tools = [get_trend, get_projects_for_trend, create_bundle_for_project]
 
 # 1. Set up memory
-# Note: This is a simple global memory for demonstration. In a real multi-user app,
-# you would manage separate memory instances for each user session.
-memory = ConversationBufferMemory(memory_key="chat_history", return_messages=True)
+# Each chat session gets its own windowed memory so histories don't leak between
+# users and the prompt only carries the last few exchanges.
+MEMORY_WINDOW_SIZE = 5
+MAX_SESSIONS = 1000
+# Cookie that carries the session id when the client doesn't send one explicitly
+SESSION_COOKIE = "chat_session_id"
+
+session_memories = OrderedDict()
+session_memories_lock = threading.Lock()
+
+def get_session_memory(session_id):
+    # Least recently used sessions are evicted once MAX_SESSIONS is reached
+    with session_memories_lock:
+        memory = session_memories.get(session_id)
+        if memory is None:
+            memory = ConversationBufferWindowMemory(k=MEMORY_WINDOW_SIZE, memory_key="chat_history", return_messages=True)
+            session_memories[session_id] = memory
+            if len(session_memories) > MAX_SESSIONS:
+                session_memories.popitem(last=False)
+        else:
+            session_memories.move_to_end(session_id)
+        return memory
 
 # 2. Update the prompt to include chat history
-template = """You are a friendly and helpful creative shopping assistant for a craft store. Your goal is to help users find and create DIY projects.
+template = """You are a friendly creative shopping assistant for a craft store, helping users find DIY projects.
 
-You have access to the following tools:
+Tools:
 {tools}
 
-**Conversation Flow:**
+Flow:
+- New topic (e.g. "winter projects"): call `get_trend`, then `get_projects_for_trend`, then answer with the project names as `choices`.
+- If the input exactly matches a project name from the history, call `create_bundle_for_project` with it right away; do not call the other tools.
 
-1.  When the user starts a new conversation (e.g., "winter projects"), your primary goal is to identify a trend. Use the `get_trend` tool.
-2.  Once a trend is identified, use the `get_projects_for_trend` tool to get a list of project names.
-3.  After you get the list of projects, your next response to the user MUST be to present these choices. Use the `Final Answer` format with the `choices` key.
-4.  The user will then respond with one of the choices. Your job is to look at the user's input and the previous conversation history (`chat_history`). If the user's input exactly matches one of the project names you just offered, you MUST NOT use `get_trend` or `get_projects_for_trend` again. Instead, you MUST immediately use the `create_bundle_for_project` tool with the project name the user selected.
-5.  After calling `create_bundle_for_project`, provide the final answer with the project details.
-
-Here is the conversation history:
+History:
 {chat_history}
 
-Use the following format for your thoughts and actions:
-
+Format:
 Thought: Do I need to use a tool? Yes
-Action: The action to take, should be one of [{tool_names}]
-Action Input: The input to the action
-Observation: The result of the action
-
-When you have a response to say to the Human, you MUST use the format:
+Action: one of [{tool_names}]
+Action Input: the input to the action
+Observation: the result of the action
 
+To answer the Human:
 Thought: Do I need to use a tool? No
-Final Answer: A JSON object with a "conversation" key. If you have a list of projects to show, add a "choices" key containing the list of project names. If you have a final project bundle, add a "project" key containing the output from the `create_bundle_for_project` tool.
+Final Answer: a JSON object with a "conversation" key, plus "choices" (list of project names) when applicable.
 
 Input: {input}
 {agent_scratchpad}
@@ -258,26 +423,65 @@ Input: {input}
 
 prompt = PromptTemplate.from_template(template)
 
-# 3. Create the agent and agent executor with memory
+# 3. Create the agent; an executor is built per request around the session's memory
 agent = create_react_agent(llm, tools, prompt)
-agent_executor = AgentExecutor(agent=agent, tools=tools, verbose=True, memory=memory, handle_parsing_errors=True)
+
+def get_agent_executor(session_id):
+    memory = get_session_memory(session_id)
+    return AgentExecutor(agent=agent, tools=tools, verbose=True, memory=memory, handle_parsing_errors=True)
 
 
 # --- Flask App ---
+# Seconds between heartbeats while waiting for the next agent event
+SSE_HEARTBEAT_INTERVAL = 1
+
+# Stop browsers and reverse proxies (e.g. nginx) from caching or buffering the stream
+SSE_HEADERS = {
+    "Cache-Control": "no-cache",
+    "X-Accel-Buffering": "no",
+}
+
+# Agent runs share a bounded pool; requests beyond the limit wait in the pool's
+# queue (still receiving heartbeats) instead of each spawning a new thread.
+MAX_CONCURRENT_AGENTS = 16
+agent_run_pool = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_AGENTS, thread_name_prefix="agent-run")
+
 app = Flask(__name__)
 CORS(app, resources={r"/*": {"origins": "*"}})
 
 @app.route("/chat_stream", methods=["GET"])
 def chat_stream():
     user_input = request.args.get("message")
+    # Clients without a session get a fresh one, returned both as a cookie and as
+    # the first stream event so they can pass it back as the session_id parameter
+    session_id = request.args.get("session_id") or request.cookies.get(SESSION_COOKIE) or uuid.uuid4().hex
 
     if not user_input:
         return jsonify({"error": "No message provided"}), 400
 
+    agent_executor = get_agent_executor(session_id)
+    # A message that is exactly a project name is a selection from the offered
+    # choices, so the bundle is built directly without an agent round-trip.
+    selected_project = PROJECT_NAMES.get(user_input.strip().lower())
+
     def generate_events():
         q = Queue()
         callback_handler = AgentStepCallbackHandler(q)
 
+        def run_bundle():
+            try:
+                answer_str = create_bundle_for_project.invoke(
+                    selected_project,
+                    config={"callbacks": [callback_handler]}
+                )
+                agent_executor.memory.save_context({"input": user_input}, {"output": answer_str})
+                q.put({"type": "final_answer", "content": answer_str})
+            except Exception as e:
+                print(f"Bundle creation error during streaming: {e}")
+                q.put({"type": "error", "content": f"An error occurred: {str(e)}"})
+            finally:
+                q.put({"type": "stream_end"}) # Signal the end of the stream
+
         def run_agent():
             try:
                 agent_executor.invoke(
@@ -290,25 +494,33 @@ def chat_stream():
             finally:
                 q.put({"type": "stream_end"}) # Signal the end of the stream
 
-        thread = threading.Thread(target=run_agent)
-        thread.start()
+        agent_run_pool.submit(run_bundle if selected_project else run_agent)
+
+        # Flush the response headers right away so the client sees the stream open
+        # before the agent produces its first step.
+        yield f"data: {orjson.dumps({'type': 'session', 'session_id': session_id}).decode()}\n\n"
 
         while True:
             try:
-                event = q.get(timeout=1) # Wait for an event with a timeout
+                # q.get wakes up as soon as an event is enqueued; the timeout only
+                # sets how often a heartbeat is sent while the agent is thinking.
+                event = q.get(timeout=SSE_HEARTBEAT_INTERVAL)
                 if event.get("type") == "stream_end":
                     break # Exit loop when stream ends
-                yield f"data: {json.dumps(event)}\n\n"
+                yield f"data: {orjson.dumps(event).decode()}\n\n"
             except Empty:
-                # Send a heartbeat or just continue if no event for 1 second
+                # Send a heartbeat if no event arrived within the interval
                 # This keeps the connection alive and allows the client to detect disconnections
                 yield "data: {}\n\n" # Heartbeat
             except Exception as e:
                 print(f"Error in event generation: {e}")
-                yield f"data: {json.dumps({'type': 'error', 'content': f'Error generating events: {str(e)}'})}\n\n"
+                yield f"data: {orjson.dumps({'type': 'error', 'content': f'Error generating events: {str(e)}'}).decode()}\n\n"
                 break
 
-    return Response(generate_events(), mimetype='text/event-stream')
+    response = Response(generate_events(), mimetype='text/event-stream', headers=SSE_HEADERS)
+    response.set_cookie(SESSION_COOKIE, session_id, httponly=True, samesite="Lax")
+    return response
 
 if __name__ == "__main__":
-    app.run(debug=True, port=5000)
\ No newline at end of file
+    # Development server only; use gunicorn (see gunicorn.conf.py) in production
+    app.run(debug=True, port=5000, threaded=True)
\ No newline at end of file
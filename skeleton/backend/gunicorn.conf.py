@@ -0,0 +1,14 @@
+# Production server settings: gunicorn -c gunicorn.conf.py app:app
+
+bind = "0.0.0.0:5000"
+
+# Each /chat_stream connection holds a thread while the agent runs, and the work is
+# mostly waiting on Gemini, so one process with many threads serves the streams.
+# Chat memory lives in the process, so more workers would split a session's history.
+worker_class = "gthread"
+workers = 1
+threads = 32
+
+# Agent runs can take a while before the stream finishes
+timeout = 120
+keepalive = 5